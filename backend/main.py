@@ -1,6 +1,6 @@
 from fastapi import FastAPI, File, UploadFile, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse
+from fastapi.responses import JSONResponse, Response
 from fastapi.staticfiles import StaticFiles
 from contextlib import asynccontextmanager
 import os
@@ -8,26 +8,148 @@ import shutil
 import subprocess
 import uuid
 import asyncio
+import errno
+import hashlib
 import logging
 import time
+from collections import deque
+from pathlib import Path
+
+import aiofiles
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-TEMP_DIR = "temp_files"
-OUTPUT_DIR = "output_files"
 
-# Ensure directories exist before mounting StaticFiles
-os.makedirs(TEMP_DIR, exist_ok=True)
-os.makedirs(OUTPUT_DIR, exist_ok=True)
+# Only default to tmpfs when it has room for real videos; Docker gives containers a
+# 64 MB /dev/shm unless they're started with --shm-size
+TMPFS_MIN_FREE_BYTES = int(os.environ.get("WM_TMPFS_MIN_FREE_MB", 2048)) * 1024 * 1024
+
+
+def _working_dir(env_var: str, default: str, fallback: str) -> Path:
+    """Use a RAM-backed directory when it is usable and big enough, otherwise local disk."""
+    path = Path(os.environ.get(env_var, default))
+    try:
+        path.mkdir(parents=True, exist_ok=True)
+        # An explicit WM_TEMP/WM_OUTPUT is taken as is; only the tmpfs default is size-checked
+        if env_var not in os.environ and shutil.disk_usage(path).free < TMPFS_MIN_FREE_BYTES:
+            raise OSError(errno.ENOSPC, "not enough free space", str(path))
+    except OSError as e:
+        logger.warning(f"Can't use {path} for {env_var} ({e}); falling back to {fallback}")
+        path = Path(fallback)
+        path.mkdir(parents=True, exist_ok=True)
+    return path
+
+
+# Keep inputs, encodes and downloads in RAM when there's room: the saved copies of the
+# uploads and every FFmpeg read/write then skip the container's (often networked) disk
+TEMP_DIR = _working_dir("WM_TEMP", "/dev/shm/watermark/temp", "temp_files")
+OUTPUT_DIR = _working_dir("WM_OUTPUT", "/dev/shm/watermark/output", "output_files")
+
+# Finished outputs are deleted this long after they were last written or served from cache
+OUTPUT_TTL_SECONDS = int(os.environ.get("OUTPUT_TTL_SECONDS", 15 * 60))
+REAP_INTERVAL_SECONDS = 60
+
+# Uploads are copied to disk in 1 MiB chunks
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+# Number of encode workers, i.e. FFmpeg processes running at once; other jobs wait in
+# JOB_QUEUE. Each libx264 run already uses every core, so default to half the CPUs
+# (min 1) to keep parallel encodes from thrashing each other's caches.
+ENCODE_CONCURRENCY = max(1, int(os.environ.get("ENCODE_CONCURRENCY", (os.cpu_count() or 1) // 2)))
+
+# Jobs by id (the session id that created them); JOB_QUEUE holds the ids still waiting
+JOBS: dict[str, dict] = {}
+JOB_QUEUE: asyncio.Queue[str] = asyncio.Queue()
+
+# Keep FFmpeg's stderr small: errors only, plus machine-readable -progress blocks
+FFMPEG_QUIET = ['-hide_banner', '-loglevel', 'error', '-nostats']
+STDERR_TAIL_LINES = 200
+
+# libx264 thread count; "0" lets x264 pick based on the available cores
+X264_THREADS = os.environ.get("X264_THREADS", "0")
+
+# When running behind nginx, set this to an `internal` location aliased to OUTPUT_DIR
+# (e.g. "/protected/") and nginx will send the file itself via X-Accel-Redirect
+X_ACCEL_REDIRECT_PREFIX = os.environ.get("X_ACCEL_REDIRECT_PREFIX", "")
+
+
+# FFmpeg capabilities, resolved once in lifespan() so the request path never has to probe
+FFMPEG_BIN = "ffmpeg"
+FFPROBE_BIN = "ffprobe"
+FFMPEG_AVAILABLE = False
+HAS_NVENC = False
+HAS_OVERLAY_CUDA = False
+
+
+def _ffmpeg_lists(flag: str) -> str:
+    """Return the stdout of `ffmpeg -hide_banner <flag>` (e.g. -encoders, -filters), or "" on failure."""
+    try:
+        result = subprocess.run(
+            [FFMPEG_BIN, '-hide_banner', flag],
+            capture_output=True, text=True, timeout=10
+        )
+    except (OSError, subprocess.TimeoutExpired):
+        return ""
+    return result.stdout if result.returncode == 0 else ""
+
+
+def _nvenc_works() -> bool:
+    """Encode one tiny frame with h264_nvenc; distro builds list the encoder even without a GPU."""
+    try:
+        result = subprocess.run(
+            [FFMPEG_BIN, '-hide_banner', '-loglevel', 'error',
+             '-init_hw_device', 'cuda=gpu',
+             '-f', 'lavfi', '-i', 'color=black:s=256x256',
+             '-frames:v', '1', '-c:v', 'h264_nvenc', '-f', 'null', '-'],
+            capture_output=True, timeout=20
+        )
+    except (OSError, subprocess.TimeoutExpired):
+        return False
+    return result.returncode == 0
+
+
+async def _reap_old_outputs() -> None:
+    """Periodically delete outputs and finished jobs older than OUTPUT_TTL_SECONDS."""
+    while True:
+        cutoff = time.time() - OUTPUT_TTL_SECONDS
+        for job_id, job in list(JOBS.items()):
+            if job["finished_at"] is not None and job["finished_at"] < cutoff:
+                del JOBS[job_id]
+        for path in OUTPUT_DIR.iterdir():
+            try:
+                if path.stat().st_mtime < cutoff:
+                    path.unlink()
+                    logger.info(f"Reaped expired output {path.name}")
+            except OSError:
+                pass
+        await asyncio.sleep(REAP_INTERVAL_SECONDS)
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    logger.info("Watermark API started. Directories ready.")
+    global FFMPEG_BIN, FFPROBE_BIN, FFMPEG_AVAILABLE, HAS_NVENC, HAS_OVERLAY_CUDA
+    FFPROBE_BIN = shutil.which("ffprobe") or FFPROBE_BIN
+    resolved = shutil.which("ffmpeg")
+    FFMPEG_AVAILABLE = resolved is not None
+    if FFMPEG_AVAILABLE:
+        FFMPEG_BIN = resolved
+        HAS_NVENC = 'h264_nvenc' in _ffmpeg_lists('-encoders') and _nvenc_works()
+        HAS_OVERLAY_CUDA = HAS_NVENC and 'overlay_cuda' in _ffmpeg_lists('-filters')
+    logger.info(
+        f"Watermark API started. Directories ready. ffmpeg={resolved}, "
+        f"NVENC available: {HAS_NVENC}, overlay_cuda: {HAS_OVERLAY_CUDA}, "
+        f"concurrent encodes: {ENCODE_CONCURRENCY}"
+    )
+    background = [asyncio.create_task(_reap_old_outputs())]
+    background += [asyncio.create_task(_encode_worker()) for _ in range(ENCODE_CONCURRENCY)]
     yield
+    for task in background:
+        task.cancel()
+    # Let cancelled workers kill and reap their FFmpeg before the temp files go away
+    await asyncio.gather(*background, return_exceptions=True)
     for d in [TEMP_DIR]:
-        if os.path.exists(d):
+        if d.exists():
             shutil.rmtree(d, ignore_errors=True)
 
 
@@ -42,82 +164,348 @@ app.add_middleware(
     expose_headers=["Content-Disposition"],
 )
 
-# Serve output files as static files for direct download
-app.mount("/downloads", StaticFiles(directory=OUTPUT_DIR), name="downloads")
 
+# Logo scale/alpha prep, applied once up front by _preprocess_logo() rather than per video frame
+LOGO_FILTER = "format=rgba,scale=trunc(iw/4)*2:-1"
 
-def apply_watermark(input_video: str, logo: str, output_video: str, logo_type: str = "png") -> bool:
-    try:
-        start_time = time.time()
-        logger.info(f"Starting FFmpeg: logo_type={logo_type}")
-        logger.info(f"Input video: {os.path.getsize(input_video) / (1024*1024):.1f} MB")
-        logger.info(f"Logo: {os.path.getsize(logo) / (1024*1024):.1f} MB")
-
-        if logo_type == "anim":
-            filter_complex = (
-                "[0:v]scale=trunc(iw/2)*2:trunc(ih/2)*2[base];"
-                "[1:v]format=rgba,colorchannelmixer=aa=1.0,"
-                "scale=trunc(iw/4)*2:-1[wm];"
-                "[base][wm]overlay=W-w-10:H-h-10:shortest=1"
-            )
-            command = [
-                'ffmpeg', '-y',
-                '-i', input_video,
-                '-stream_loop', '-1',
-                '-i', logo,
-                '-filter_complex', filter_complex,
-                '-c:v', 'libx264',
-                '-preset', 'ultrafast',
-                '-crf', '23',
-                '-threads', '1',
-                '-max_muxing_queue_size', '1024',
-                '-c:a', 'copy',
-                output_video
-            ]
-        else:
-            filter_complex = (
-                "[0:v]scale=trunc(iw/2)*2:trunc(ih/2)*2[base];"
-                "[1:v]format=rgba,colorchannelmixer=aa=1.0,"
-                "scale=trunc(iw/4)*2:-1[logo];"
-                "[base][logo]overlay=W-w-10:H-h-10"
-            )
-            command = [
-                'ffmpeg', '-y',
-                '-i', input_video,
-                '-i', logo,
-                '-filter_complex', filter_complex,
-                '-c:v', 'libx264',
-                '-preset', 'ultrafast',
-                '-crf', '23',
-                '-threads', '1',
-                '-max_muxing_queue_size', '1024',
-                '-c:a', 'copy',
-                output_video
-            ]
-
-        logger.info(f"FFmpeg command: {' '.join(command)}")
 
-        result = subprocess.run(
-            command, check=True,
-            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-            timeout=600
+def _build_filter(is_anim: bool, use_nvenc: bool, even_dims: bool) -> str:
+    # [1:v] is the logo already scaled by _preprocess_logo()
+    shortest = ":shortest=1" if is_anim else ""
+    if use_nvenc and HAS_OVERLAY_CUDA:
+        # NVDEC already hands us CUDA frames, so only the small logo stream is
+        # uploaded; compositing stays on the GPU. yuva420p needs an even height, so
+        # an odd-height logo gets one transparent row rather than being rescaled.
+        return (
+            "[1:v]pad=iw:ceil(ih/2)*2:color=black@0,format=yuva420p,hwupload[wm];"
+            f"[0:v][wm]overlay_cuda=W-w-10:H-h-10{shortest}"
         )
+    # Without overlay_cuda, NVDEC frames are pulled back down as nv12 so the
+    # RGBA logo can be composited on the CPU before NVENC picks them up.
+    stages = []
+    if use_nvenc:
+        stages.append("hwdownload,format=nv12")
+    if not even_dims:
+        # yuv420p needs even dimensions; only pay for a full-frame rescale when they're odd
+        stages.append("scale=trunc(iw/2)*2:trunc(ih/2)*2")
+    if not stages:
+        return f"[0:v][1:v]overlay=W-w-10:H-h-10{shortest}"
+    return (
+        f"[0:v]{','.join(stages)}[base];"
+        f"[base][1:v]overlay=W-w-10:H-h-10{shortest}"
+    )
 
-        elapsed = time.time() - start_time
-        output_size = os.path.getsize(output_video) / (1024 * 1024)
-        logger.info(f"FFmpeg completed in {elapsed:.1f}s. Output: {output_size:.1f} MB")
-        return True
 
-    except subprocess.TimeoutExpired:
-        logger.error("FFmpeg timed out after 10 minutes.")
-        return False
-    except subprocess.CalledProcessError as e:
-        logger.error(f"FFmpeg Error:\n{e.stderr.decode()}")
-        return False
+def _build_cmd(
+    input_video: Path, logo: Path, output_video: Path, is_anim: bool, use_nvenc: bool, even_dims: bool
+) -> list[str]:
+    command = [FFMPEG_BIN, '-y', *FFMPEG_QUIET, '-progress', 'pipe:2']
+    if use_nvenc:
+        command += [
+            '-init_hw_device', 'cuda=gpu',
+            '-filter_hw_device', 'gpu',
+            '-hwaccel', 'cuda',
+            '-hwaccel_device', 'gpu',
+            '-hwaccel_output_format', 'cuda',
+        ]
+    command += ['-i', str(input_video)]
+    if is_anim:
+        command += ['-stream_loop', '-1']
+    command += ['-i', str(logo), '-filter_complex', _build_filter(is_anim, use_nvenc, even_dims)]
+    if use_nvenc:
+        command += ['-c:v', 'h264_nvenc', '-preset', 'p4', '-tune', 'hq', '-rc', 'vbr', '-cq', '23']
+    else:
+        # Low-latency x264: sliced threads spread each frame across cores, no lookahead/B-frames
+        command += [
+            '-c:v', 'libx264', '-preset', 'ultrafast', '-tune', 'fastdecode', '-crf', '23',
+            '-x264-params', 'sliced-threads=1:sync-lookahead=0:rc-lookahead=0:bframes=0',
+            '-threads', X264_THREADS,
+        ]
+    command += [
+        '-max_muxing_queue_size', '1024',
+        '-c:a', 'copy',
+        '-movflags', '+faststart',
+        str(output_video)
+    ]
+    return command
+
+
+async def save_upload(upload: UploadFile, path: Path) -> None:
+    """Copy an upload to disk chunk by chunk without blocking the event loop."""
+    async with aiofiles.open(path, "wb") as f:
+        while chunk := await upload.read(UPLOAD_CHUNK_SIZE):
+            await f.write(chunk)
+
+
+def file_sha256(path: Path) -> str:
+    # file_digest hashes in C straight from the file, releasing the GIL as it goes
+    with open(path, "rb") as f:
+        return hashlib.file_digest(f, "sha256").hexdigest()
+
+
+async def _drain_stderr(stream: asyncio.StreamReader) -> deque[str]:
+    """Read FFmpeg's stderr line by line, keeping only the last STDERR_TAIL_LINES non-progress lines."""
+    tail: deque[str] = deque(maxlen=STDERR_TAIL_LINES)
+    progress: dict[str, str] = {}
+    async for raw in stream:
+        line = raw.decode(errors='replace').rstrip()
+        # -progress writes bare key=value lines, some padded (e.g. "speed= 1.5x")
+        key, sep, value = line.partition('=')
+        if sep and key.isidentifier():
+            progress[key] = value.strip()
+            if key == 'progress':
+                logger.debug(f"FFmpeg progress: out_time={progress.get('out_time')} speed={progress.get('speed')}")
+            continue
+        if line:
+            tail.append(line)
+    return tail
+
+
+async def _run_ffmpeg(command: list[str], timeout: int = 600) -> bool:
+    """Run one FFmpeg command, logging the tail of its stderr if it fails."""
+    logger.info(f"FFmpeg command: {' '.join(command)}")
+    try:
+        proc = await asyncio.create_subprocess_exec(
+            *command,
+            stdin=asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.PIPE,
+        )
     except FileNotFoundError:
         logger.error("FFmpeg not found.")
         return False
 
+    stderr_task = asyncio.create_task(_drain_stderr(proc.stderr))
+    try:
+        returncode = await asyncio.wait_for(proc.wait(), timeout=timeout)
+    except asyncio.TimeoutError:
+        logger.error(f"FFmpeg timed out after {timeout}s.")
+        return False
+    finally:
+        # Don't leave FFmpeg running on a timeout or a cancelled job
+        if proc.returncode is None:
+            proc.kill()
+            await proc.wait()
+        # stderr hits EOF once FFmpeg is gone, so this always finishes
+        stderr_tail = await stderr_task
+
+    if returncode != 0:
+        logger.error(f"FFmpeg exited with {returncode}:\n" + "\n".join(stderr_tail))
+        return False
+    return True
+
+
+async def _probe_dimensions(video: Path) -> tuple[int, int] | None:
+    """Return the (width, height) of the first video stream, or None if ffprobe can't tell."""
+    try:
+        proc = await asyncio.create_subprocess_exec(
+            FFPROBE_BIN, '-v', 'error', '-select_streams', 'v:0',
+            '-show_entries', 'stream=width,height', '-of', 'csv=p=0', str(video),
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.DEVNULL,
+        )
+    except OSError:
+        return None
+
+    try:
+        stdout, _ = await asyncio.wait_for(proc.communicate(), timeout=30)
+    except asyncio.TimeoutError:
+        return None
+    finally:
+        # Don't leave ffprobe running on a timeout or a cancelled job
+        if proc.returncode is None:
+            proc.kill()
+            await proc.wait()
+    try:
+        width, height = stdout.decode().split()[0].split(',')[:2]
+        return int(width), int(height)
+    except (IndexError, ValueError):
+        return None
+
+
+async def _preprocess_logo(logo: Path, is_anim: bool) -> Path | None:
+    """Scale the logo and convert it to RGBA once, so the main encode only has to overlay it."""
+    if is_anim:
+        # qtrle keeps the alpha channel and is cheap to encode and decode
+        scaled = logo.with_name(f"{logo.stem}_scaled.mov")
+        codec = ['-c:v', 'qtrle']
+    else:
+        scaled = logo.with_name(f"{logo.stem}_scaled.png")
+        codec = ['-frames:v', '1']
+    command = [FFMPEG_BIN, '-y', *FFMPEG_QUIET, '-i', str(logo), '-vf', LOGO_FILTER, '-an', *codec, str(scaled)]
+    if not await _run_ffmpeg(command, timeout=120):
+        scaled.unlink(missing_ok=True)
+        return None
+    return scaled
+
+
+async def apply_watermark(input_video: Path, logo: Path, output_video: Path, logo_type: str = "png") -> bool:
+    start_time = time.time()
+    is_anim = logo_type == "anim"
+    logger.info(f"Starting FFmpeg: logo_type={logo_type}")
+    logger.info(f"Input video: {input_video.stat().st_size / (1024*1024):.1f} MB")
+    logger.info(f"Logo: {logo.stat().st_size / (1024*1024):.1f} MB")
+
+    dims = await _probe_dimensions(input_video)
+    even_dims = dims is not None and dims[0] % 2 == 0 and dims[1] % 2 == 0
+    logger.info(f"Input dimensions: {dims}")
+
+    scaled_logo = await _preprocess_logo(logo, is_anim)
+    if scaled_logo is None:
+        return False
+
+    try:
+        command = _build_cmd(input_video, scaled_logo, output_video, is_anim, HAS_NVENC, even_dims)
+        success = await _run_ffmpeg(command)
+        if not success and HAS_NVENC:
+            # Some inputs (ProRes, 4:2:2 or 10-bit HEVC, VP8...) don't survive the CUDA
+            # pipeline; the CPU path handles anything FFmpeg can decode
+            logger.warning("NVENC encode failed; retrying with libx264.")
+            output_video.unlink(missing_ok=True)
+            command = _build_cmd(input_video, scaled_logo, output_video, is_anim, False, even_dims)
+            success = await _run_ffmpeg(command)
+        if not success:
+            return False
+    finally:
+        scaled_logo.unlink(missing_ok=True)
+
+    elapsed = time.time() - start_time
+    output_size = output_video.stat().st_size / (1024 * 1024)
+    logger.info(f"FFmpeg completed in {elapsed:.1f}s. Output: {output_size:.1f} MB")
+    return True
+
+
+def session_dir(session_id: str) -> Path:
+    return TEMP_DIR / session_id
+
+
+def cleanup_session_files(session_id: str) -> None:
+    """Remove everything a session wrote to TEMP_DIR in one go."""
+    shutil.rmtree(session_dir(session_id), ignore_errors=True)
+
+
+def _job_status(job_id: str, job: dict) -> dict:
+    status = {"job_id": job_id, "state": job["state"], "cached": job["cached"]}
+    if job["state"] == "done":
+        status["download_url"] = f"/downloads/{job['output_filename']}"
+        status["filename"] = job["filename"]
+    return status
+
+
+async def _run_job(job_id: str, job: dict) -> None:
+    output_video_path = OUTPUT_DIR / job["output_filename"]
+    # FFmpeg writes to a per-job name first so a failed or concurrent encode never
+    # leaves a partial file where a cache hit would find it. It lives next to the final
+    # output so the rename below stays on one filesystem.
+    partial_video_path = OUTPUT_DIR / f"{output_video_path.stem}_{job_id}.partial.mp4"
+    try:
+        success = await apply_watermark(
+            job["video_path"], job["logo_path"], partial_video_path, job["logo_type"]
+        )
+        if not success or not partial_video_path.exists():
+            logger.error(f"Processing failed for job {job_id}")
+            job["state"] = "failed"
+            return
+        partial_video_path.replace(output_video_path)
+    finally:
+        partial_video_path.unlink(missing_ok=True)
+
+    job["state"] = "done"
+    logger.info(f"Job {job_id} complete! Download URL: /downloads/{job['output_filename']}")
+
+
+async def _encode_worker() -> None:
+    """Take jobs off JOB_QUEUE one at a time; ENCODE_CONCURRENCY of these run in parallel."""
+    while True:
+        job_id = await JOB_QUEUE.get()
+        job = JOBS[job_id]
+        job["state"] = "running"
+        try:
+            await _run_job(job_id, job)
+        except Exception:
+            logger.exception(f"Job {job_id} crashed")
+            job["state"] = "failed"
+        finally:
+            job["finished_at"] = time.time()
+            cleanup_session_files(job_id)
+            JOB_QUEUE.task_done()
+
+
+async def _save_input(upload: UploadFile, path: Path) -> None:
+    try:
+        await save_upload(upload, path)
+    except OSError as e:
+        if e.errno == errno.ENOSPC:
+            logger.error(f"Out of space saving {path}")
+            raise HTTPException(status_code=507, detail="Server is out of storage space. Try again later.") from e
+        raise
+
+
+async def _enqueue_session(session_id: str, video: UploadFile, logo: UploadFile) -> tuple[str, dict]:
+    """Save both uploads and queue an encode, unless an identical one is cached or in flight."""
+    work_dir = session_dir(session_id)
+    work_dir.mkdir()
+
+    # Save Logo
+    logo_ext = Path(logo.filename).suffix.lower()
+    input_logo_path = work_dir / f"logo{logo_ext}"
+    logger.info("Saving logo...")
+    await _save_input(logo, input_logo_path)
+    logger.info(f"Logo saved: {input_logo_path.stat().st_size / (1024*1024):.1f} MB")
+
+    is_anim = logo_ext in ['.mov', '.webm']
+    logo_type = "anim" if is_anim else "png"
+
+    # Save Video. It has to land on disk: the upload is closed once we've answered
+    # the request, long before a worker gets to it.
+    video_ext = Path(video.filename).suffix.lower()
+    input_video_path = work_dir / f"video{video_ext}"
+    logger.info("Saving video...")
+    await _save_input(video, input_video_path)
+    logger.info(f"Video saved: {input_video_path.stat().st_size / (1024*1024):.1f} MB")
+
+    # Hash both inputs off the event loop; the files were just written, so reads hit RAM
+    video_hash, logo_hash = await asyncio.gather(
+        asyncio.to_thread(file_sha256, input_video_path),
+        asyncio.to_thread(file_sha256, input_logo_path),
+    )
+
+    # Outputs are named after their inputs, so a repeated upload can reuse the earlier encode
+    cache_key = hashlib.sha256(f"{video_hash}:{logo_hash}:{logo_type}".encode()).hexdigest()[:16]
+    output_filename = f"{cache_key}.mp4"
+    output_video_path = OUTPUT_DIR / output_filename
+
+    job = {
+        "state": "queued",
+        "cached": False,
+        "output_filename": output_filename,
+        "filename": f"watermarked_{video.filename}",
+        "video_path": input_video_path,
+        "logo_path": input_logo_path,
+        "logo_type": logo_type,
+        "finished_at": None,
+    }
+
+    if output_video_path.exists():
+        logger.info(f"Cache hit for session {session_id}: /downloads/{output_filename}")
+        # Restart the TTL so the reaper doesn't delete it from under the client
+        output_video_path.touch()
+        job.update(state="done", cached=True, finished_at=time.time())
+        cleanup_session_files(session_id)
+        JOBS[session_id] = job
+        return session_id, job
+
+    for other_id, other in JOBS.items():
+        if other["output_filename"] == output_filename and other["state"] in ("queued", "running"):
+            logger.info(f"Session {session_id} joins in-flight job {other_id}")
+            cleanup_session_files(session_id)
+            return other_id, other
+
+    JOBS[session_id] = job
+    await JOB_QUEUE.put(session_id)
+    logger.info(f"Queued job {session_id} ({JOB_QUEUE.qsize()} waiting)")
+    return session_id, job
+
 
 @app.post("/watermark")
 async def create_watermark(
@@ -130,70 +518,54 @@ async def create_watermark(
     session_id = str(uuid.uuid4())
     logger.info(f"New request: session={session_id}, video={video.filename}, logo={logo.filename}")
 
-    # Save Video
-    video_ext = os.path.splitext(video.filename)[1]
-    input_video_path = os.path.join(TEMP_DIR, f"{session_id}_video{video_ext}")
-    logger.info("Saving video...")
-    with open(input_video_path, "wb") as buffer:
-        shutil.copyfileobj(video.file, buffer)
-    logger.info(f"Video saved: {os.path.getsize(input_video_path) / (1024*1024):.1f} MB")
+    try:
+        job_id, job = await _enqueue_session(session_id, video, logo)
+    except BaseException:
+        # Clean up inputs; on success the worker does this once the encode is finished
+        cleanup_session_files(session_id)
+        raise
 
-    # Save Logo
-    logo_ext = os.path.splitext(logo.filename)[1].lower()
-    input_logo_path = os.path.join(TEMP_DIR, f"{session_id}_logo{logo_ext}")
-    logger.info("Saving logo...")
-    with open(input_logo_path, "wb") as buffer:
-        shutil.copyfileobj(logo.file, buffer)
-    logger.info(f"Logo saved: {os.path.getsize(input_logo_path) / (1024*1024):.1f} MB")
+    # Answer straight away; the client polls /status/{job_id} until the encode is done
+    status_code = 200 if job["state"] == "done" else 202
+    return JSONResponse(status_code=status_code, content=_job_status(job_id, job))
 
-    # Output goes to the output_files directory so it can be served as a static download
-    output_filename = f"{session_id}_watermarked.mp4"
-    output_video_path = os.path.join(OUTPUT_DIR, output_filename)
 
-    is_anim = logo_ext in ['.mov', '.webm']
-    logo_type = "anim" if is_anim else "png"
+@app.get("/status/{job_id}")
+def job_status(job_id: str):
+    job = JOBS.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown job.")
+    return _job_status(job_id, job)
 
-    # Run FFmpeg in a thread
-    logger.info("Starting FFmpeg...")
-    loop = asyncio.get_event_loop()
-    success = await loop.run_in_executor(
-        None, apply_watermark, input_video_path, input_logo_path, output_video_path, logo_type
-    )
 
-    # Clean up inputs
-    for p in [input_video_path, input_logo_path]:
-        if os.path.exists(p):
-            try:
-                os.remove(p)
-            except OSError:
-                pass
+@app.get("/")
+def read_root():
+    return {"message": "Watermark API is running."}
 
-    if not success or not os.path.exists(output_video_path):
-        logger.error(f"Processing failed for session {session_id}")
-        raise HTTPException(status_code=500, detail="FFmpeg processing failed.")
 
-    # Return a JSON response with the download URL instead of streaming the whole file
-    logger.info(f"Processing complete! Download URL: /downloads/{output_filename}")
-    return {
-        "success": True,
-        "download_url": f"/downloads/{output_filename}",
-        "filename": f"watermarked_{video.filename}",
-    }
+def accel_redirect_download(filename: str):
+    filename = Path(filename).name
+    if not (OUTPUT_DIR / filename).is_file():
+        raise HTTPException(status_code=404, detail="File not found.")
+    # nginx streams the file from its internal location; we only send headers
+    return Response(
+        media_type="video/mp4",
+        headers={"X-Accel-Redirect": f"{X_ACCEL_REDIRECT_PREFIX.rstrip('/')}/{filename}"},
+    )
 
 
-@app.get("/")
-def read_root():
-    return {"message": "Watermark API is running."}
+if X_ACCEL_REDIRECT_PREFIX:
+    app.add_api_route("/downloads/{filename}", accel_redirect_download, methods=["GET", "HEAD"])
+else:
+    # Serve output files as static files for direct download
+    app.mount("/downloads", StaticFiles(directory=OUTPUT_DIR), name="downloads")
 
 
 @app.get("/health")
 def health_check():
-    try:
-        result = subprocess.run(['ffmpeg', '-version'], capture_output=True, timeout=5)
-        ffmpeg_ok = result.returncode == 0
-    except Exception:
-        ffmpeg_ok = False
     return {
-        "status": "healthy" if ffmpeg_ok else "degraded",
-        "ffmpeg_available": ffmpeg_ok,
+        "status": "healthy" if FFMPEG_AVAILABLE else "degraded",
+        "ffmpeg_available": FFMPEG_AVAILABLE,
+        "nvenc_available": HAS_NVENC,
+        "overlay_cuda_available": HAS_OVERLAY_CUDA,
     }
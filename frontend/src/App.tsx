@@ -13,6 +13,8 @@ type Message = {
 
 // Assuming the fastAPI backend runs locally on this port or uses an env variable in production
 const API_URL = import.meta.env.VITE_API_URL || 'http://localhost:8000';
+const POLL_INTERVAL_MS = 2000;
+const MAX_WAIT_MS = 30 * 60 * 1000; // give up on a job that hasn't finished after 30 minutes
 
 function App() {
   const [messages, setMessages] = useState<Message[]>([
@@ -74,13 +76,27 @@ function App() {
     formData.append('video', video);
 
     try {
-      // Step 1: Send the files for processing (response is now JSON with a download URL)
+      // Step 1: Upload the files; the server queues the job and answers with a job id
       const response = await axios.post(`${API_URL}/watermark`, formData, {
-        timeout: 600000, // 10 minutes — large videos need time to process on the server
+        timeout: 600000, // 10 minutes — large uploads can take a while
       });
 
-      // Step 2: Build the full download URL from the API response
-      const downloadUrl = `${API_URL}${response.data.download_url}`;
+      // Step 2: Poll the job until the encode finishes (cached results come back already done)
+      let job = response.data;
+      const deadline = Date.now() + MAX_WAIT_MS;
+      while (job.state === 'queued' || job.state === 'running') {
+        if (Date.now() > deadline) {
+          throw new Error(`Watermark job ${job.job_id} timed out while ${job.state}`);
+        }
+        await new Promise(resolve => setTimeout(resolve, POLL_INTERVAL_MS));
+        job = (await axios.get(`${API_URL}/status/${job.job_id}`)).data;
+      }
+      if (job.state !== 'done') {
+        throw new Error(`Watermark job ${job.job_id} ${job.state}`);
+      }
+
+      // Step 3: Build the full download URL from the job status
+      const downloadUrl = `${API_URL}${job.download_url}`;
 
       addMessage({
         sender: "bot",